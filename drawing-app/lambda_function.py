@@ -1,13 +1,154 @@
+import concurrent.futures
 import json
+import logging
 import boto3
-import urllib.request
-import urllib.error
-import base64
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+import urllib3
+import functools
+import hashlib
+import io
 from datetime import datetime
 import os
-import traceback
-
-s3_client = boto3.client("s3")
+import re
+import time
+import uuid
+
+logger = logging.getLogger()
+
+# An unknown LOG_LEVEL falls back to INFO instead of failing every cold start
+log_level = getattr(logging, os.environ.get("LOG_LEVEL", "INFO").upper(), None)
+logger.setLevel(log_level if isinstance(log_level, int) else logging.INFO)
+
+# Configuration is fixed for the lifetime of the execution environment
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
+CACHE_TABLE_NAME = os.environ.get("CACHE_TABLE_NAME")
+
+# Fail the cold start rather than every request when misconfigured
+if not GEMINI_API_KEY:
+    raise RuntimeError("GEMINI_API_KEY not configured")
+
+# Optional: SIMD base64 decoder with the same API as the stdlib module
+try:
+    import pybase64 as b64
+except ImportError:
+    import base64 as b64
+
+# Optional: orjson for the multi-MB request/response bodies. json_dumps
+# returns compact UTF-8 bytes and json_loads accepts str or bytes either way.
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    json_loads = json.loads
+
+# Optional: perceptual hashing for the similar-sketch cache tier
+try:
+    import imagehash
+    from PIL import Image
+except ImportError:
+    imagehash = None
+
+# Module-level client so warm invocations reuse the pooled keep-alive connections
+s3_client = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=50,
+        tcp_keepalive=True,
+        retries={"max_attempts": 3, "mode": "adaptive"},
+    ),
+)
+
+# Background S3 uploads, overlapped with building the response
+upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+S3_UPLOAD_TIMEOUT = 10
+
+# Generation cache (optional): sketch hash + style -> S3 key of a prior result
+cache_table = (
+    boto3.resource("dynamodb").Table(CACHE_TABLE_NAME) if CACHE_TABLE_NAME else None
+)
+
+# Similar-sketch tier: GSI (style, created_at) over entries that carry a phash
+CACHE_STYLE_INDEX = "style-index"
+PHASH_SCAN_LIMIT = 50
+PHASH_MAX_DISTANCE = 6
+# Larger images are not hashed; phash decodes at full size before shrinking
+PHASH_MAX_PIXELS = 4096 * 4096
+
+STYLE_PROMPTS = {
+    "realistic": "photorealistic, highly detailed, professional photography, natural lighting, 8k quality",
+    "anime": "anime style, vibrant colors, Japanese animation aesthetic, cel-shaded, manga inspired",
+    "cartoon": "cartoon style, bold colors, playful illustration, animated feel, exaggerated features",
+    "oil-painting": "oil painting style, classical art, textured brushstrokes, rich colors, artistic masterpiece",
+    "watercolor": "watercolor painting, soft washes, delicate colors, artistic, painted on paper texture",
+    "sketch": "detailed pencil sketch, hand-drawn, artistic line work, shading and hatching, graphite drawing",
+    "3d-render": "3D rendered, computer graphics, smooth surfaces, professional CGI, octane render, unreal engine",
+    "pixel-art": "pixel art style, retro gaming aesthetic, 8-bit or 16-bit graphics, pixelated, sprite art",
+    "cyberpunk": "cyberpunk style, neon lights, futuristic, sci-fi aesthetic, dark with bright accents, technological",
+    "fantasy": "fantasy art style, magical atmosphere, ethereal, epic illustration, mystical and enchanting",
+}
+
+# Cheap sanity checks so malformed input fails before reaching Gemini
+BASE64_PREFIX_RE = re.compile(r"[A-Za-z0-9+/=]+")
+
+# Accepted sketch mime types and their (offset, magic bytes) signatures
+SKETCH_SIGNATURES = {
+    "image/png": ((0, b"\x89PNG\r\n\x1a\n"),),
+    "image/jpeg": ((0, b"\xff\xd8\xff"),),
+    "image/webp": ((0, b"RIFF"), (8, b"WEBP")),
+}
+
+# Multipart part headers for the Files API, built only from the allowlist above
+SKETCH_PART_HEADERS = {
+    mime: f"Content-Type: {mime}\r\n\r\n".encode("ascii") for mime in SKETCH_SIGNATURES
+}
+
+CORS_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type,x-api-key,Authorization,x-style",
+    "Access-Control-Allow-Methods": "POST,OPTIONS",
+}
+
+# Static part of the Gemini payload
+GEMINI_STATIC_PAYLOAD = {
+    "generationConfig": {"responseModalities": ["TEXT", "IMAGE"]},
+    "safetySettings": [
+        {
+            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+            "threshold": "BLOCK_MEDIUM_AND_ABOVE",
+        },
+        {
+            "category": "HARM_CATEGORY_HATE_SPEECH",
+            "threshold": "BLOCK_MEDIUM_AND_ABOVE",
+        },
+        {
+            "category": "HARM_CATEGORY_HARASSMENT",
+            "threshold": "BLOCK_MEDIUM_AND_ABOVE",
+        },
+        {
+            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+            "threshold": "BLOCK_MEDIUM_AND_ABOVE",
+        },
+    ],
+}
+
+# Serialized once as a ',"generationConfig":...}' tail to splice onto contents
+GEMINI_PAYLOAD_TAIL = b"," + json_dumps(GEMINI_STATIC_PAYLOAD)[1:]
+
+# Shared pool for Gemini calls; survives across warm invocations
+gemini_http = urllib3.PoolManager(
+    maxsize=10,
+    retries=urllib3.Retry(total=2, backoff_factor=0.2),
+    timeout=urllib3.Timeout(connect=5, read=90),
+)
 
 
 def lambda_handler(event, context):
@@ -16,294 +157,561 @@ def lambda_handler(event, context):
     """
     try:
         # ===== FIX: Handle ALL possible event formats =====
-        print("=== RAW EVENT ===")
-        print(json.dumps(event, default=str))
+        # The event can carry the whole image, only serialize it when debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Raw event: %s", json.dumps(event, default=str))
 
         # Initialize body as None
         body = None
+        mime_type = "image/png"
+
+        # Case 0: API Gateway binary media type, body is already the base64 image
+        if isinstance(event, dict) and event.get("isBase64Encoded"):
+            logger.debug("Case 0: API Gateway binary body")
+            body, mime_type = binary_request_body(event)
+
+            if mime_type is None:
+                return error_response(
+                    "Unsupported image type, expected PNG, JPEG or WebP", 400
+                )
 
         # Case 1: API Gateway with body field (most common)
-        if isinstance(event, dict) and "body" in event:
-            print("Case 1: API Gateway format with 'body' field")
+        elif isinstance(event, dict) and "body" in event:
+            logger.debug("Case 1: API Gateway format with 'body' field")
             body_content = event["body"]
 
             if isinstance(body_content, str):
                 # Body is JSON string, parse it
                 try:
-                    body = json.loads(body_content)
-                    print("Successfully parsed JSON body string")
+                    body = json_loads(body_content)
+                    logger.debug("Successfully parsed JSON body string")
                 except json.JSONDecodeError as e:
-                    print(f"JSON decode error: {e}")
+                    logger.warning("JSON decode error: %s", e)
                     return error_response(f"Invalid JSON: {str(e)}", 400)
             elif isinstance(body_content, dict):
                 # Body is already a dict
                 body = body_content
-                print("Body is already a dict")
+                logger.debug("Body is already a dict")
             else:
-                print(f"Unexpected body type: {type(body_content)}")
+                logger.warning("Unexpected body type: %s", type(body_content))
                 return error_response("Invalid body format", 400)
 
         # Case 2: Direct invocation (test event)
         elif isinstance(event, dict) and "imageData" in event:
-            print("Case 2: Direct invocation format")
+            logger.debug("Case 2: Direct invocation format")
             body = event
 
         # Case 3: Event is the body itself
         elif isinstance(event, dict):
-            print("Case 3: Event is the body")
+            logger.debug("Case 3: Event is the body")
             body = event
 
         else:
-            print(f"Unexpected event type: {type(event)}")
+            logger.warning("Unexpected event type: %s", type(event))
             return error_response("Invalid event format", 400)
 
         # ===== Validate body =====
         if body is None:
-            print("ERROR: body is None")
+            logger.warning("body is None")
             return error_response("No request body", 400)
 
         if not isinstance(body, dict):
-            print(f"ERROR: body is not a dict, it's {type(body)}")
+            logger.warning("body is not a dict, it's %s", type(body))
             return error_response("Body must be an object", 400)
 
-        print(f"Body keys: {list(body.keys())}")
+        logger.info("Body keys: %s", body.keys())
 
         # ===== Extract data =====
         image_data = body.get("imageData")
         style = body.get("style", "realistic")
 
-        print(f"imageData exists: {image_data is not None}")
-        print(f"imageData type: {type(image_data)}")
-        print(f"imageData length: {len(image_data) if image_data else 0}")
-        print(f"style: {style}")
-
-        # Get API key
-        api_key = os.environ.get("GEMINI_API_KEY")
-
-        if not api_key:
-            print("ERROR: GEMINI_API_KEY not set")
-            return error_response("GEMINI_API_KEY not configured", 500)
+        logger.debug("imageData exists: %s", image_data is not None)
+        logger.debug("imageData type: %s", type(image_data))
+        logger.info("imageData length: %d", len(image_data) if image_data else 0)
+        logger.info("style: %s", style)
 
         # ===== Validate imageData =====
         if not image_data:
-            print("ERROR: imageData is empty or missing")
-            print(f"Full body received: {json.dumps(body, default=str)}")
+            # Keys, types and lengths only: the body may still hold a large payload
+            logger.warning(
+                "imageData is empty or missing, body summary: %s",
+                [
+                    (k, type(v).__name__, len(v) if hasattr(v, "__len__") else "-")
+                    for k, v in body.items()
+                ],
+            )
             return error_response("No image data provided", 400)
 
         if not isinstance(image_data, str):
-            print(f"ERROR: imageData is not a string, it's {type(image_data)}")
+            logger.warning("imageData is not a string, it's %s", type(image_data))
             return error_response("imageData must be a string", 400)
 
         if len(image_data) < 10:
-            print(f"ERROR: imageData too short: {len(image_data)} chars")
+            logger.warning("imageData too short: %d chars", len(image_data))
             return error_response("imageData is too short", 400)
 
         # ===== Process imageData =====
-        mime_type = "image/png"
-
         if image_data.startswith("data:image"):
-            print("Removing data URL prefix...")
-            parts = image_data.split(",")
-            if len(parts) == 2:
-                mime_type = image_data.split(";")[0].split(":")[1]
-                image_data = parts[1]
-                print(f"Extracted mime type: {mime_type}")
-                print(f"New imageData length: {len(image_data)}")
-            else:
-                print("ERROR: Invalid data URL format")
+            logger.debug("Removing data URL prefix...")
+            # partition stops at the first comma; only the short header is parsed further
+            header, sep, image_data = image_data.partition(",")
+            if not sep:
+                logger.warning("Invalid data URL format")
                 return error_response("Invalid data URL format", 400)
 
-        print(f"Processing sketch with style: {style}, mime: {mime_type}")
+            mime_type = header[5:].partition(";")[0].strip().lower()
+            logger.debug("Extracted mime type: %s", mime_type)
+            logger.debug("New imageData length: %d", len(image_data))
+
+        if mime_type not in SKETCH_SIGNATURES:
+            logger.warning("Unsupported sketch mime type: %r", mime_type)
+            return error_response(
+                "Unsupported image type, expected PNG, JPEG or WebP", 400
+            )
+
+        if len(image_data) % 4 or not BASE64_PREFIX_RE.fullmatch(image_data[:32]):
+            logger.warning("imageData is not valid base64")
+            return error_response("Malformed base64 image data", 400)
+
+        logger.info("Processing sketch with style: %s, mime: %s", style, mime_type)
+
+        # The input is decoded exactly once, here. The raw bytes feed the cache
+        # key, the pHash and the Gemini Files API upload; nothing downstream
+        # decodes image_data again or re-encodes the sketch to base64.
+        try:
+            sketch_bytes = b64.b64decode(image_data, validate=False)
+        except ValueError as e:
+            # binascii.Error (bad padding) and non-ASCII input are both ValueErrors
+            logger.warning("imageData failed to decode: %s", e)
+            return error_response("Malformed base64 image data", 400)
+
+        if not all(
+            sketch_bytes.startswith(magic, offset)
+            for offset, magic in SKETCH_SIGNATURES[mime_type]
+        ):
+            logger.warning("imageData does not match %s", mime_type)
+            return error_response(f"imageData is not a valid {mime_type} image", 400)
+
+        # ===== Check cache =====
+        sketch_hash = hashlib.sha256(sketch_bytes).hexdigest()
+        cache_key = f"{sketch_hash}:{style}"
+        cached = get_cached_generation(cache_key)
+        sketch_phash = None
+
+        if not cached and cache_table is not None:
+            sketch_phash = perceptual_hash(sketch_bytes)
+            cached = find_similar_generation(sketch_phash, style)
+
+        if cached:
+            cached_prompt, cached_image, cached_url = cached
+            logger.info("Cache hit, skipping generation")
+            return success_response(cached_prompt, cached_image, cached_url, style)
 
         # ===== Generate image =====
-        print("Generating image with Gemini...")
+        logger.info("Generating image with Gemini...")
         generated_image_base64, prompt_used = generate_image_from_sketch(
-            api_key, image_data, style, mime_type
+            GEMINI_API_KEY, sketch_bytes, style, mime_type
         )
 
         if not generated_image_base64:
-            print("ERROR: Image generation failed")
+            logger.error("Image generation failed")
             return error_response("Failed to generate image", 500)
 
-        print("Image generated successfully")
-
-        # Upload to S3
-        s3_url = upload_to_s3(generated_image_base64, style)
+        logger.info("Image generated successfully")
+
+        # Upload to S3 in the background while the response is built. Every
+        # generation gets its own object, so handed-out URLs never change content.
+        s3_key = f"generated-images/{sketch_hash}_{style}_{uuid.uuid4().hex}.png"
+        s3_url, upload_future = upload_to_s3(generated_image_base64, s3_key)
+        image_data_url = f"data:image/png;base64,{generated_image_base64}"
+        response = success_response(prompt_used, image_data_url, s3_url, style)
+
+        # The upload must finish before returning, Lambda freezes afterwards
+        if upload_future is not None:
+            if wait_for_upload(upload_future):
+                put_cached_generation(
+                    cache_key, s3_key, prompt_used, style, sketch_phash
+                )
+            else:
+                response = success_response(prompt_used, image_data_url, None, style)
 
         # ===== Return success =====
-        response_data = {
-            "success": True,
-            "data": {
-                "prompt": prompt_used,
-                "imageBase64": f"data:image/png;base64,{generated_image_base64}",
-                "s3Url": s3_url,
-                "style": style,
-            },
-        }
-
-        print("Returning success response")
-        return {
-            "statusCode": 200,
-            "headers": cors_headers(),
-            "body": json.dumps(response_data),
-        }
+        logger.debug("Returning success response")
+        return response
 
     except Exception as e:
-        print(f"EXCEPTION: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Request handling failed")
         return error_response(str(e), 500)
 
 
-def generate_image_from_sketch(api_key, sketch_data, style, mime_type):
+def binary_request_body(event):
+    """Build (body, mime_type) for a binary upload, mime_type is None if unsupported"""
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    query = event.get("queryStringParameters") or {}
+
+    body = {
+        "imageData": event.get("body"),
+        "style": query.get("style") or headers.get("x-style") or "realistic",
+    }
+
+    # Generic or missing content types keep the PNG default
+    content_type = headers.get("content-type") or ""
+    mime_type = content_type.partition(";")[0].strip().lower()
+
+    if mime_type in ("", "application/octet-stream"):
+        mime_type = "image/png"
+    elif mime_type not in SKETCH_SIGNATURES:
+        logger.warning("Unsupported binary content type: %r", content_type)
+        mime_type = None
+
+    return body, mime_type
+
+
+def generate_image_from_sketch(api_key, sketch_bytes, style, mime_type):
     """Generate image using Gemini 2.5 Flash Image Preview"""
+    assert isinstance(sketch_bytes, bytes), "sketch must be decoded once by the caller"
+
     try:
-        style_prompts = {
-            "realistic": "photorealistic, highly detailed, professional photography, natural lighting, 8k quality",
-            "anime": "anime style, vibrant colors, Japanese animation aesthetic, cel-shaded, manga inspired",
-            "cartoon": "cartoon style, bold colors, playful illustration, animated feel, exaggerated features",
-            "oil-painting": "oil painting style, classical art, textured brushstrokes, rich colors, artistic masterpiece",
-            "watercolor": "watercolor painting, soft washes, delicate colors, artistic, painted on paper texture",
-            "sketch": "detailed pencil sketch, hand-drawn, artistic line work, shading and hatching, graphite drawing",
-            "3d-render": "3D rendered, computer graphics, smooth surfaces, professional CGI, octane render, unreal engine",
-            "pixel-art": "pixel art style, retro gaming aesthetic, 8-bit or 16-bit graphics, pixelated, sprite art",
-            "cyberpunk": "cyberpunk style, neon lights, futuristic, sci-fi aesthetic, dark with bright accents, technological",
-            "fantasy": "fantasy art style, magical atmosphere, ethereal, epic illustration, mystical and enchanting",
-        }
-
-        style_desc = style_prompts.get(style, "high quality artistic style")
+        style_desc = STYLE_PROMPTS.get(style, "high quality artistic style")
         full_prompt = f"Transform this sketch into a beautiful image, {style_desc}, masterpiece quality, professional artwork"
 
-        print(f"Using prompt: {full_prompt}")
-
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image-preview:generateContent?key={api_key}"
-
-        payload = {
-            "contents": [
-                {
-                    "role": "user",
-                    "parts": [
-                        {"text": full_prompt},
-                        {
-                            "inlineData": {
-                                "mimeType": mime_type,
-                                "data": sketch_data,
-                            }
-                        },
-                    ],
-                }
-            ],
-            "generationConfig": {"responseModalities": ["TEXT", "IMAGE"]},
-            "safetySettings": [
-                {
-                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE",
-                },
-                {
-                    "category": "HARM_CATEGORY_HATE_SPEECH",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE",
-                },
-                {
-                    "category": "HARM_CATEGORY_HARASSMENT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE",
-                },
-                {
-                    "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                    "threshold": "BLOCK_MEDIUM_AND_ABOVE",
-                },
-            ],
-        }
-
-        data_bytes = json.dumps(payload).encode("utf-8")
-        req = urllib.request.Request(url, data=data_bytes, method="POST")
-        req.add_header("Content-Type", "application/json")
+        logger.info("Using prompt: %s", full_prompt)
+
+        # Send the sketch once as raw bytes and reference it by URI below
+        file_name, file_uri = upload_sketch_to_gemini(
+            api_key, sketch_bytes, mime_type
+        )
+
+        if not file_uri:
+            return None, full_prompt
 
         try:
-            with urllib.request.urlopen(req, timeout=90) as response:
-                response_body = response.read().decode("utf-8")
-                data = json.loads(response_body)
-
-                if "candidates" in data and len(data["candidates"]) > 0:
-                    parts = data["candidates"][0].get("content", {}).get("parts", [])
-
-                    # Find image part
-                    image_part = next(
-                        (
-                            p
-                            for p in parts
-                            if "inlineData" in p
-                            and p["inlineData"].get("mimeType", "").startswith("image/")
-                        ),
-                        None,
-                    )
-
-                    if image_part:
-                        image_base64 = image_part["inlineData"].get("data")
-                        if image_base64:
-                            print(f"Generated image size: {len(image_base64)} chars")
-                            return image_base64, full_prompt
-
-                print("No image in API response")
-                print(f"Response: {json.dumps(data, indent=2)}")
+            url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image-preview:generateContent?key={api_key}"
+
+            payload = {
+                "contents": [
+                    {
+                        "role": "user",
+                        "parts": [
+                            {"text": full_prompt},
+                            {
+                                "fileData": {
+                                    "mimeType": mime_type,
+                                    "fileUri": file_uri,
+                                }
+                            },
+                        ],
+                    }
+                ],
+            }
+
+            # Splice the pre-serialized static tail onto the dynamic contents
+            contents_blob = json_dumps(payload)
+            data_bytes = contents_blob[:-1] + GEMINI_PAYLOAD_TAIL
+            response = gemini_http.request(
+                "POST",
+                url,
+                body=data_bytes,
+                headers={"Content-Type": "application/json"},
+            )
+            if response.status >= 400:
+                logger.error(
+                    "Gemini API error %s: %s",
+                    response.status,
+                    response.data.decode("utf-8"),
+                )
                 return None, full_prompt
 
-        except urllib.error.HTTPError as e:
-            error_body = e.read().decode("utf-8")
-            print(f"Gemini API error {e.code}: {error_body}")
+            # Parse the raw bytes directly, the response carries the base64 image
+            data = json_loads(response.data)
+
+            if "candidates" in data and len(data["candidates"]) > 0:
+                parts = data["candidates"][0].get("content", {}).get("parts", [])
+
+                # Find image part
+                image_part = None
+                for p in parts:
+                    inline = p.get("inlineData")
+                    if inline and inline.get("mimeType", "").startswith("image/"):
+                        image_part = inline
+                        break
+
+                if image_part:
+                    image_base64 = image_part.get("data")
+                    if image_base64:
+                        logger.info("Generated image size: %d chars", len(image_base64))
+                        return image_base64, full_prompt
+
+            logger.warning("No image in API response: %s", data)
             return None, full_prompt
 
-    except Exception as e:
-        print(f"Error generating image: {str(e)}")
-        traceback.print_exc()
+        finally:
+            # The sketch is only needed for this call, free the project's file quota
+            delete_gemini_file(api_key, file_name)
+
+    except Exception:
+        logger.exception("Error generating image")
         return None, ""
 
 
-def upload_to_s3(image_base64, style):
-    """Upload to S3 with pre-signed URL"""
-    bucket_name = os.environ.get("S3_BUCKET_NAME")
+def upload_sketch_to_gemini(api_key, sketch_bytes, mime_type):
+    """Upload sketch to the Gemini Files API, return (file name, file URI)"""
+    # Never interpolate the caller's mime type into the multipart headers
+    part_header = SKETCH_PART_HEADERS.get(mime_type)
+
+    if part_header is None:
+        logger.error("Refusing to upload sketch with mime type %r", mime_type)
+        return None, None
+
+    url = f"https://generativelanguage.googleapis.com/upload/v1beta/files?key={api_key}"
+    boundary = uuid.uuid4().hex
+
+    metadata = json_dumps({"file": {"displayName": "sketch"}})
+    body = b"".join(
+        [
+            f"--{boundary}\r\n".encode("ascii"),
+            b"Content-Type: application/json; charset=UTF-8\r\n\r\n",
+            metadata,
+            f"\r\n--{boundary}\r\n".encode("ascii"),
+            part_header,
+            sketch_bytes,
+            f"\r\n--{boundary}--\r\n".encode("ascii"),
+        ]
+    )
+
+    response = gemini_http.request(
+        "POST",
+        url,
+        body=body,
+        headers={
+            "X-Goog-Upload-Protocol": "multipart",
+            "Content-Type": f"multipart/related; boundary={boundary}",
+        },
+    )
+    if response.status >= 400:
+        logger.error(
+            "Gemini file upload error %s: %s",
+            response.status,
+            response.data.decode("utf-8"),
+        )
+        return None, None
+
+    uploaded_file = json_loads(response.data).get("file", {})
+    logger.info("Uploaded sketch to Gemini: %s", uploaded_file.get("uri"))
+    return uploaded_file.get("name"), uploaded_file.get("uri")
+
+
+def delete_gemini_file(api_key, file_name):
+    """Delete an uploaded sketch from the Gemini Files API, best effort"""
+    if not file_name:
+        return
+
+    url = f"https://generativelanguage.googleapis.com/v1beta/{file_name}?key={api_key}"
+
+    try:
+        response = gemini_http.request("DELETE", url)
+        if response.status >= 400:
+            logger.warning(
+                "Gemini file delete error %s: %s",
+                response.status,
+                response.data.decode("utf-8"),
+            )
+    except Exception as e:
+        logger.warning("Gemini file delete failed: %s", e)
+
+
+def upload_to_s3(image_base64, filename):
+    """Start S3 upload in the background, return (pre-signed URL, future)"""
+    bucket_name = S3_BUCKET_NAME
 
     if not bucket_name:
-        print("S3_BUCKET_NAME not configured, skipping upload")
+        logger.info("S3_BUCKET_NAME not configured, skipping upload")
+        return None, None
+
+    upload_future = upload_executor.submit(
+        put_image, bucket_name, filename, image_base64
+    )
+
+    # Signing is local and does not need the object to exist yet
+    try:
+        s3_url = presigned_url(bucket_name, filename)
+    except Exception as e:
+        logger.error("S3 pre-signing failed: %s", e)
+        s3_url = None
+
+    return s3_url, upload_future
+
+
+def put_image(bucket_name, filename, image_base64):
+    """Decode and upload a generated image to S3"""
+    # BytesIO wraps the decoded buffer without copying it; upload_fileobj
+    # streams from it (multipart above 8MB) instead of holding another copy
+    image_buffer = io.BytesIO(b64.b64decode(image_base64, validate=False))
+
+    s3_client.upload_fileobj(
+        image_buffer,
+        bucket_name,
+        filename,
+        ExtraArgs={"ContentType": "image/png"},
+    )
+
+    logger.info("Uploaded to S3: %s", filename)
+
+
+def wait_for_upload(upload_future):
+    """Wait for a background S3 upload, return whether it succeeded"""
+    try:
+        upload_future.result(timeout=S3_UPLOAD_TIMEOUT)
+        return True
+    except Exception as e:
+        logger.error("S3 upload failed: %s", e)
+        return False
+
+
+def presigned_url(bucket_name, key):
+    """Generate pre-signed GET URL (1 hour), reused for up to 30 minutes"""
+    # URLs rotate every 30 minutes, so a reused one always has 30+ minutes left
+    return _presign(bucket_name, key, int(time.time() // 1800))
+
+
+@functools.lru_cache(maxsize=1024)
+def _presign(bucket_name, key, expiry_bucket):
+    return s3_client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket_name, "Key": key},
+        ExpiresIn=3600,
+    )
+
+
+def get_cached_generation(cache_key):
+    """Look up a previous generation, return (prompt, image data URL, s3_url) or None"""
+    bucket_name = S3_BUCKET_NAME
+
+    if cache_table is None or not bucket_name:
         return None
 
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"generated-images/drawing_{timestamp}_{style}.png"
+        item = cache_table.get_item(Key={"k": cache_key}).get("Item")
+        if not item:
+            return None
 
-        image_bytes = base64.b64decode(image_base64)
+        return load_cached_generation(bucket_name, item)
 
-        s3_client.put_object(
-            Bucket=bucket_name, Key=filename, Body=image_bytes, ContentType="image/png"
-        )
+    except Exception as e:
+        logger.warning("Cache lookup failed: %s", e)
+        return None
+
+
+def find_similar_generation(sketch_phash, style):
+    """Look up a recent generation of a visually similar sketch, same result as get_cached_generation"""
+    bucket_name = S3_BUCKET_NAME
+
+    if sketch_phash is None or cache_table is None or not bucket_name:
+        return None
+
+    try:
+        items = cache_table.query(
+            IndexName=CACHE_STYLE_INDEX,
+            KeyConditionExpression=Key("style").eq(style),
+            ScanIndexForward=False,
+            Limit=PHASH_SCAN_LIMIT,
+        ).get("Items", [])
+
+        for item in items:
+            distance = bin(sketch_phash ^ int(item["phash"])).count("1")
+            if distance <= PHASH_MAX_DISTANCE:
+                logger.info("Similar sketch found, phash distance %d", distance)
+                return load_cached_generation(bucket_name, item)
+
+        return None
 
-        # Generate pre-signed URL (1 hour)
-        s3_url = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket_name, "Key": filename},
-            ExpiresIn=3600,
+    except Exception as e:
+        logger.warning("Similar cache lookup failed: %s", e)
+        return None
+
+
+def load_cached_generation(bucket_name, item):
+    """Fetch a cached image from S3, return (prompt, image data URL, s3_url)"""
+    # Keep the response shape of a fresh generation, clients rely on imageBase64
+    s3_object = s3_client.get_object(Bucket=bucket_name, Key=item["s3_key"])
+    image_base64 = b64.b64encode(s3_object["Body"].read()).decode("ascii")
+    image_data_url = f"data:image/png;base64,{image_base64}"
+
+    # Old pre-signed URLs have expired, sign a fresh one
+    return (
+        item.get("prompt", ""),
+        image_data_url,
+        presigned_url(bucket_name, item["s3_key"]),
+    )
+
+
+def put_cached_generation(cache_key, s3_key, prompt, style, sketch_phash):
+    """Record a generation so identical or similar requests can reuse it"""
+    if cache_table is None:
+        return
+
+    item = {"k": cache_key, "s3_key": s3_key, "prompt": prompt}
+
+    # Only hashed entries get the GSI keys, keeping the style index sparse
+    if sketch_phash is not None:
+        item.update(
+            {
+                "style": style,
+                "created_at": datetime.now().isoformat(),
+                "phash": sketch_phash,
+            }
         )
 
-        print(f"Uploaded to S3: {filename}")
-        return s3_url
+    try:
+        cache_table.put_item(Item=item)
+    except Exception as e:
+        logger.warning("Cache write failed: %s", e)
+
 
+def perceptual_hash(sketch_bytes):
+    """64-bit pHash of the sketch, or None if imagehash is unavailable"""
+    if imagehash is None:
+        return None
+
+    try:
+        with Image.open(io.BytesIO(sketch_bytes)) as img:
+            # open() only reads the header, so this runs before any decoding
+            if img.width * img.height > PHASH_MAX_PIXELS:
+                logger.warning(
+                    "Sketch too large to hash: %dx%d", img.width, img.height
+                )
+                return None
+
+            return int(str(imagehash.phash(img)), 16)
     except Exception as e:
-        print(f"S3 upload failed: {str(e)}")
+        logger.warning("Perceptual hash failed: %s", e)
         return None
 
 
-def error_response(message, status_code):
-    """Return error response"""
+def success_response(prompt, image_base64, s3_url, style):
+    """Return success response"""
+    response_data = {
+        "success": True,
+        "data": {
+            "prompt": prompt,
+            "imageBase64": image_base64,
+            "s3Url": s3_url,
+            "style": style,
+        },
+    }
+
     return {
-        "statusCode": status_code,
-        "headers": cors_headers(),
-        "body": json.dumps({"success": False, "error": message}),
+        "statusCode": 200,
+        "headers": CORS_HEADERS,
+        "body": json_dumps(response_data).decode("utf-8"),
     }
 
 
-def cors_headers():
-    """CORS headers"""
+def error_response(message, status_code):
+    """Return error response"""
     return {
-        "Content-Type": "application/json",
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Headers": "Content-Type,x-api-key,Authorization",
-        "Access-Control-Allow-Methods": "POST,OPTIONS",
+        "statusCode": status_code,
+        "headers": CORS_HEADERS,
+        "body": json_dumps({"success": False, "error": message}).decode("utf-8"),
     }
+